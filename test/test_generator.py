@@ -3,8 +3,14 @@ from unittest import TestCase
 
 import numpy as np
 
-from unet3d.data import add_data_to_storage, create_data_file
-from unet3d.generator_siam import get_multi_class_labels, get_training_and_validation_generators
+from unet3d.data import (add_data_to_storage, create_data_file, open_data_file, get_patch_chunkshape,
+                         rechunk_for_patches)
+from unet3d.utils import pickle_dump
+from unet3d.utils.patches import compute_patch_indices, get_patch_from_3d_data
+from unet3d.generator_siam import (get_multi_class_labels, get_training_and_validation_generators,
+                                   _normalize01, _prep_sample, BackgroundGenerator, get_subject_label,
+                                   create_patch_index_list, get_patch_indices, get_number_of_patches,
+                                   get_nonblank_samples, data_generator, get_number_of_steps)
 from unet3d.augment import generate_permutation_keys, permute_data, reverse_permute_data
 
 
@@ -12,10 +18,13 @@ class TestDataGenerator(TestCase):
     def setUp(self):
         self.tmp_files = list()
         self.data_file = None
+        self.data_files = list()
 
     def tearDown(self):
         if self.data_file:
             self.data_file.close()
+        for data_file in self.data_files:
+            data_file.close()
         self.rm_tmp_files()
 
     def create_data_file(self, n_samples=20, len_x=5, len_y=5, len_z=10, n_channels=1):
@@ -50,6 +59,53 @@ class TestDataGenerator(TestCase):
             self.assertTrue(np.all(data_storage[index] == data[index]))
             self.assertTrue(np.all(truth_storage[index] == truth[index]))
 
+    def create_siam_data_files(self, n_samples=12, image_shape=(6, 6, 6)):
+        """
+        Writes two data files with subject ids, as used by the siamese generators, and the training and validation
+        keys files. The truth of file 0 is blank for every third sample and the truth of file 1 for three out of four.
+        """
+        self.training_keys_file = "./temporary_training_keys_file.pkl"
+        self.validation_keys_file = "./temporary_validation_keys_file.pkl"
+        self.tmp_files = [self.training_keys_file, self.validation_keys_file]
+        for file_index in range(2):
+            self.tmp_files.extend(["./temporary_siam_data_file{}.h5".format(file_index),
+                                   "./temporary_siam_data_file{}.h5_nonblank_cache.npz".format(file_index)])
+        self.rm_tmp_files()
+        self.n_samples = n_samples
+        self.subject_labels = [1 if index % 3 == 2 else 0 for index in range(n_samples)]
+        random_state = np.random.RandomState(0)
+        for file_index in range(2):
+            data_file_path = "./temporary_siam_data_file{}.h5".format(file_index)
+            data_file, data_storage, truth_storage, affine_storage = create_data_file(data_file_path, 1, n_samples,
+                                                                                      image_shape)
+            for index in range(n_samples):
+                data = random_state.randint(0, 1000, size=(1,) + image_shape).astype(np.float32)
+                truth = np.zeros(image_shape, dtype=np.uint8)
+                if (file_index == 0 and index % 3 != 0) or (file_index == 1 and index % 4 == 0):
+                    corner = index % (image_shape[0] - 1)
+                    truth[corner:corner + 2, 1:3, 2:4] = 1
+                add_data_to_storage(data_storage, truth_storage, affine_storage,
+                                    np.concatenate([data, truth[np.newaxis]], axis=0), affine=np.eye(4),
+                                    n_channels=1, truth_dtype=np.uint8)
+            subject_ids = ["subject{:02d}-{}1".format(index, "ABC"[index % 3]).encode() for index in range(n_samples)]
+            data_file.create_array(data_file.root, "subject_ids", obj=subject_ids)
+            data_file.close()
+            self.data_files.append(open_data_file(data_file_path))
+        n_training = int(n_samples * 2 / 3)
+        pickle_dump(list(range(n_training)), self.training_keys_file)
+        pickle_dump(list(range(n_training, n_samples)), self.validation_keys_file)
+        return self.data_files
+
+    def collect_epoch(self, generator, n_steps):
+        labels = list()
+        for _ in range(n_steps):
+            x, y = next(generator)
+            self.assertEqual(x[0].shape, x[1].shape)
+            self.assertEqual(x[0].dtype, np.float32)
+            self.assertTrue(np.all(np.isin(y[1], (0, 1))))
+            labels.extend(y[0].tolist())
+        return sorted(labels)
+
     def rm_tmp_files(self):
         for tmp_file in self.tmp_files:
             if os.path.exists(tmp_file):
@@ -65,6 +121,212 @@ class TestDataGenerator(TestCase):
         for label in labels:
             self.assertTrue(np.all(binary_labels[:, label - 1][label_map[:, 0] == label] == 1))
 
+    def test_multi_class_labels_outside_of_truth_dtype(self):
+        label_map = np.asarray([44, 1, 0], dtype=np.uint8).reshape((1, 1, 3, 1, 1))
+        binary_labels = get_multi_class_labels(label_map, 2, (44, 300))
+        self.assertTrue(np.all(binary_labels[0, :, :, 0, 0] == [[1, 0, 0], [0, 0, 0]]))
+
+    def test_normalize01(self):
+        data = np.arange(24, dtype=np.int16).reshape((1, 2, 3, 4))
+        normalized = _normalize01(data)
+        self.assertEqual(normalized.dtype, np.float32)
+        self.assertTrue(np.allclose(normalized, (data - data.min()) / (data.max() - data.min())))
+
+        out = np.ones(data.shape, dtype=np.float32)
+        self.assertIs(_normalize01(np.full(data.shape, 7), out=out), out)
+        self.assertTrue(np.all(out == 0))
+
+    def test_prep_sample(self):
+        for use_numba in (False, True):
+            data0 = np.random.rand(1, 4, 4, 4) * 100
+            data1 = np.full((1, 4, 4, 4), 3.)
+            truth = np.zeros((1, 4, 4, 4), dtype=np.uint8)
+            out0, out1, _, _ = _prep_sample(data0, data1, truth, truth, use_numba=use_numba)
+            self.assertTrue(np.allclose(out0, _normalize01(data0)))
+            self.assertTrue(np.all(out1 == 0))
+
+            truth[0, 1, 2, 3] = 2
+            _, _, truth_out0, truth_out1 = _prep_sample(data0, data1, np.zeros_like(truth), truth,
+                                                        use_numba=use_numba)
+            self.assertTrue(np.all(truth_out0 == 0))
+            self.assertTrue(np.all(truth_out1 == (truth > 0)))
+            self.assertEqual(_prep_sample(data0, data1, truth, truth, binarize=False, use_numba=use_numba)[2].max(), 2)
+
+    def test_background_generator(self):
+        self.assertEqual(list(BackgroundGenerator(iter(range(10)), max_prefetch=2)), list(range(10)))
+
+    def test_background_generator_reraises(self):
+        def failing_generator():
+            yield 1
+            raise ValueError("failed to build the batch")
+
+        generator = BackgroundGenerator(failing_generator(), max_prefetch=2)
+        self.assertEqual(next(generator), 1)
+        self.assertRaises(ValueError, next, generator)
+
+    def test_siam_generators_with_prefetch(self):
+        data_file0, data_file1 = self.create_siam_data_files()
+        for patch_shape in (None, (3, 3, 3)):
+            epochs = list()
+            for max_prefetch in (0, 2):
+                generators = get_training_and_validation_generators(data_file0, data_file1, 3, 1,
+                                                                    self.training_keys_file,
+                                                                    self.validation_keys_file,
+                                                                    validation_batch_size=2,
+                                                                    patch_shape=patch_shape,
+                                                                    max_prefetch=max_prefetch)
+                training_generator, validation_generator, n_training_steps, n_validation_steps = generators
+                self.assertEqual(isinstance(training_generator, BackgroundGenerator), bool(max_prefetch))
+                epochs.append((self.collect_epoch(training_generator, n_training_steps),
+                               self.collect_epoch(validation_generator, n_validation_steps)))
+            self.assertEqual(epochs[0], epochs[1])
+            if patch_shape is None:
+                nonblank = [index for index in range(self.n_samples) if index % 3 != 0 or index % 4 == 0]
+                self.assertEqual(epochs[0][0], sorted(self.subject_labels[index] for index in nonblank if index < 8))
+                self.assertEqual(epochs[0][1], sorted(self.subject_labels[index] for index in nonblank if index >= 8))
+
+    def test_get_number_of_patches(self):
+        data_file0, data_file1 = self.create_siam_data_files()
+        index_list = list(range(self.n_samples))
+        truths = [data_file.root.truth.read() for data_file in (data_file0, data_file1)]
+        self.assertEqual(get_number_of_patches(data_file0, data_file1, index_list, skip_blank=False), self.n_samples)
+        self.assertEqual(get_number_of_patches(data_file0, data_file1, index_list),
+                         sum(np.any(truths[0][index]) or np.any(truths[1][index]) for index in index_list))
+        image_shape = np.asarray(data_file0.root.data.shape[-3:])
+        for patch_shape, patch_overlap in (((3, 3, 3), 0), ((4, 4, 4), 1), ((2, 3, 4), 1)):
+            patches = compute_patch_indices(image_shape, np.asarray(patch_shape), overlap=patch_overlap)
+            expected = sum(any(np.any(get_patch_from_3d_data(truth[index], patch_shape, patch))
+                               for truth in truths)
+                           for index in index_list for patch in patches)
+            self.assertEqual(get_number_of_patches(data_file0, data_file1, index_list, patch_shape=patch_shape,
+                                                   patch_overlap=patch_overlap), expected)
+            self.assertEqual(get_number_of_patches(data_file0, data_file1, index_list, patch_shape=patch_shape,
+                                                   patch_overlap=patch_overlap, skip_blank=False),
+                             len(patches) * self.n_samples)
+
+    def test_get_nonblank_samples_cache(self):
+        data_file0, _ = self.create_siam_data_files()
+        cache_file = "./temporary_siam_data_file0.h5_nonblank_cache.npz"
+        expected = np.asarray([index % 3 != 0 for index in range(self.n_samples)])
+        self.assertFalse(os.path.exists(cache_file))
+        self.assertTrue(np.all(get_nonblank_samples(data_file0) == expected))
+        with np.load(cache_file) as cache:
+            source = cache["source"]
+            self.assertTrue(np.all(cache["nonblank_samples"] == expected))
+
+        # a cache of the same data file is read instead of the truth
+        np.savez(cache_file, nonblank_samples=~expected, source=source)
+        self.assertTrue(np.all(get_nonblank_samples(data_file0) == ~expected))
+
+        # a cache of a data file with another size, modification time or number of samples is rewritten
+        for other_source in (source + [1, 0, 0], source + [0, 1, 0], source + [0, 0, 1]):
+            np.savez(cache_file, nonblank_samples=~expected, source=other_source)
+            self.assertTrue(np.all(get_nonblank_samples(data_file0) == expected))
+            with np.load(cache_file) as cache:
+                self.assertTrue(np.all(cache["source"] == source))
+
+        # as is a cache with the wrong number of samples or one that cannot be read
+        np.savez(cache_file, nonblank_samples=expected[:-1], source=source)
+        self.assertTrue(np.all(get_nonblank_samples(data_file0) == expected))
+        with open(cache_file, "w") as opened_file:
+            opened_file.write("not a cache")
+        self.assertTrue(np.all(get_nonblank_samples(data_file0) == expected))
+
+        # a cache file that cannot be written falls back to the computed samples
+        os.remove(cache_file)
+        os.mkdir(cache_file)
+        try:
+            self.assertTrue(np.all(get_nonblank_samples(data_file0) == expected))
+        finally:
+            os.rmdir(cache_file)
+
+    def test_data_generator_with_workers(self):
+        data_file0, data_file1 = self.create_siam_data_files()
+        index_list = list(range(8))
+        batch_size = 5
+        for patch_shape in (None, (3, 3, 3)):
+            n_samples = get_number_of_patches(data_file0, data_file1, index_list, patch_shape=patch_shape)
+            n_steps = get_number_of_steps(n_samples, batch_size)
+            self.assertNotEqual(n_samples % batch_size, 0)
+            epochs = list()
+            for n_workers in (0, 2):
+                generator = data_generator(data_file0, data_file1, index_list, batch_size=batch_size,
+                                           patch_shape=patch_shape, shuffle_index_list=True, n_workers=n_workers)
+                try:
+                    for _ in range(2):
+                        batch_sizes, labels, truth_sums = list(), list(), list()
+                        for _ in range(n_steps):
+                            x, y = next(generator)
+                            batch_sizes.append(len(y[0]))
+                            labels.extend(y[0].tolist())
+                            truth_sums.extend(np.sum(y[1] + y[2], axis=(1, 2, 3, 4)).tolist())
+                        self.assertEqual(batch_sizes, [batch_size] * (n_steps - 1) +
+                                         [n_samples - batch_size * (n_steps - 1)])
+                        epochs.append((sorted(labels), sorted(truth_sums)))
+                finally:
+                    generator.close()
+            self.assertTrue(all(epoch == epochs[0] for epoch in epochs))
+
+    def test_get_subject_label(self):
+        self.assertEqual(get_subject_label(b"subject01-C1"), 1)
+        self.assertEqual(get_subject_label("subject-02-A2"), 0)
+        self.assertEqual(get_subject_label(b"subject03-B1"), 0)
+        self.assertRaises(ValueError, get_subject_label, b"subject04-D1")
+
+    def test_create_patch_index_list_with_random_offset(self):
+        image_shape = np.asarray((10, 12, 9))
+        patch_shape = np.asarray((4, 4, 4))
+        patch_start_offset = (3, 2, 1)
+        index_list = [4, 0, 7]
+        np.random.seed(0)
+        patch_index_list = create_patch_index_list(index_list, image_shape, patch_shape, 0, patch_start_offset)
+        np.random.seed(0)
+        offsets = np.stack([np.random.randint(0, max_offset + 1, size=len(index_list))
+                            for max_offset in patch_start_offset], axis=1)
+        expected = [(index, patch) for index, offset in zip(index_list, offsets)
+                    for patch in compute_patch_indices(image_shape, patch_shape, overlap=0, start=-offset)]
+        self.assertEqual(len(patch_index_list), len(expected))
+        for (index, patch), (expected_index, expected_patch) in zip(patch_index_list, expected):
+            self.assertEqual(index, expected_index)
+            self.assertTrue(np.all(patch == expected_patch))
+
+    def test_create_patch_index_list_cached(self):
+        image_shape = (10, 12, 9)
+        patch_shape = (4, 4, 4)
+        index_list = [2, 5]
+        for patch_overlap in (0, np.int64(2), (1, 2, np.int64(0)), np.asarray((2, 1, 0))):
+            patch_index_list = create_patch_index_list(index_list, image_shape, patch_shape, patch_overlap)
+            patches = compute_patch_indices(np.asarray(image_shape), np.asarray(patch_shape),
+                                            overlap=np.asarray(patch_overlap))
+            self.assertEqual(patch_index_list, [(index, tuple(patch)) for index in index_list for patch in patches])
+        hits = get_patch_indices.cache_info().hits
+        create_patch_index_list(index_list, np.asarray(image_shape), np.asarray(patch_shape), 0)
+        self.assertEqual(get_patch_indices.cache_info().hits, hits + 1)
+
+    def test_get_patch_chunkshape(self):
+        self.assertEqual(get_patch_chunkshape((64, 64, 64), 4), (1, 1, 64, 64, 64))
+        self.assertEqual(get_patch_chunkshape((128, 128, 128), 4), (1, 1, 64, 64, 64))
+        self.assertEqual(get_patch_chunkshape((128, 128, 128), 1), (1, 1, 64, 128, 128))
+        self.assertEqual(get_patch_chunkshape((100, 30, 30), 4), (1, 1, 100, 30, 30))
+        self.assertEqual(get_patch_chunkshape((101, 64, 64), 8), (1, 1, 51, 32, 64))
+
+    def test_rechunk_for_patches(self):
+        self.create_siam_data_files()
+        rechunked_file_path = "./temporary_rechunked_data_file.h5"
+        self.tmp_files.append(rechunked_file_path)
+        patch_shape = (4, 4, 4)
+        data_file_path = "./temporary_siam_data_file0.h5"
+        rechunk_for_patches(data_file_path, rechunked_file_path, patch_shape)
+        with open_data_file(data_file_path) as original, open_data_file(rechunked_file_path) as rechunked:
+            for name in ("data", "truth"):
+                self.assertEqual(rechunked.get_node("/", name).chunkshape, (1, 1) + patch_shape)
+            for name in ("data", "truth", "affine"):
+                original_array = original.get_node("/", name).read()
+                rechunked_array = rechunked.get_node("/", name).read()
+                self.assertEqual(original_array.dtype, rechunked_array.dtype)
+                self.assertTrue(np.all(original_array == rechunked_array))
+            self.assertEqual(original.root.subject_ids.read(), rechunked.root.subject_ids.read())
+
     def test_get_training_and_validation_generators(self):
         self.create_data_file()
 
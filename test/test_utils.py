@@ -5,6 +5,7 @@ import numpy as np
 
 from unet3d.utils.utils import resize
 from unet3d.utils.sitk_utils import resample_to_spacing
+from unet3d.utils.patches import get_patch_from_3d_data, get_patch_from_hdf5, get_nonblank_patches
 
 
 class TestUtils(TestCase):
@@ -67,3 +68,23 @@ class TestUtils(TestCase):
                                                                    [0., 1., 0., -0.5],
                                                                    [0., 0., 1., -0.5],
                                                                    [0., 0., 0., 1.]])))
+
+    def test_get_patch_from_hdf5(self):
+        dataset = np.arange(2 * 3 * 6 * 6 * 6).reshape((2, 3, 6, 6, 6))
+        patch_shape = (4, 4, 4)
+        for patch_index in ((0, 0, 0), (1, 2, 2), (-2, 0, 3), (4, -1, 5), (-4, 0, 0), (-5, 0, 0), (2, 6, -7),
+                            (7, 9, 1)):
+            patch = get_patch_from_hdf5(dataset, 1, patch_shape, patch_index)
+            self.assertEqual(patch.shape, (3,) + patch_shape)
+            self.assertTrue(np.all(patch == get_patch_from_3d_data(dataset[1], patch_shape, patch_index)))
+
+    def test_get_nonblank_patches(self):
+        data = np.zeros((8, 8, 8), dtype=np.uint8)
+        data[0, 7, 3] = 1
+        data[5, 5, 5] = 2
+        patch_shape = (3, 3, 3)
+        patch_indices = np.asarray([(x, y, z) for x in range(-2, 8, 2) for y in range(-2, 8, 3) for z in (-1, 3, 6)])
+        nonblank = get_nonblank_patches(data, patch_indices, patch_shape)
+        expected = [np.any(get_patch_from_3d_data(data, patch_shape, patch_index)) for patch_index in patch_indices]
+        self.assertTrue(np.any(nonblank))
+        self.assertTrue(np.all(nonblank == expected))
@@ -7,6 +7,11 @@ import tables
 
 from unet3d.normalize import normalize_data_storage, reslice_image_set
 
+# hdf5 chunk cache used when opening data files, sized so that consecutive patch reads hit the cache
+CHUNK_CACHE_SIZE = 64 * 1024 * 1024
+CHUNK_CACHE_NELMTS = 1000003
+MAX_CHUNK_BYTES = 1024 * 1024
+
 
 def create_data_file(out_file, n_channels, n_samples, image_shape):
     hdf5_file = tables.open_file(out_file, mode='w')
@@ -73,5 +78,53 @@ def write_data_to_file(training_data_files, out_file, image_shape, truth_dtype=n
     return out_file
 
 
-def open_data_file(filename, readwrite="r"):
-    return tables.open_file(filename, readwrite)
+def open_data_file(filename, readwrite="r", chunk_cache_size=CHUNK_CACHE_SIZE):
+    """
+    Opens an hdf5 data file.
+    :param chunk_cache_size: Size in bytes of the hdf5 chunk cache of each array in the file. Set to None to keep the
+    pytables default.
+    """
+    if chunk_cache_size is None:
+        return tables.open_file(filename, readwrite)
+    return tables.open_file(filename, readwrite, CHUNK_CACHE_SIZE=chunk_cache_size,
+                            CHUNK_CACHE_NELMTS=CHUNK_CACHE_NELMTS)
+
+
+def get_patch_chunkshape(patch_shape, itemsize, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Computes an hdf5 chunk shape for (n_samples, n_channels, x, y, z) storage that holds a single channel of a single
+    patch. The largest dimension is halved until the chunk fits within max_chunk_bytes.
+    :param patch_shape: shape of the patches that will be read from the data file.
+    :param itemsize: number of bytes per value.
+    :param max_chunk_bytes: upper limit on the size of a chunk. Default is 1 MiB.
+    :return: chunk shape tuple of length 5.
+    """
+    chunk = [int(length) for length in patch_shape]
+    while np.prod(chunk) * itemsize > max_chunk_bytes and max(chunk) > 1:
+        largest = int(np.argmax(chunk))
+        chunk[largest] = (chunk[largest] + 1) // 2
+    return tuple([1, 1] + chunk)
+
+
+def rechunk_for_patches(in_file, out_file, patch_shape, max_chunk_bytes=MAX_CHUNK_BYTES):
+    """
+    Copies an hdf5 data file so that the chunks of the data and truth arrays are aligned with the patches read by the
+    data generator. Should be run once after write_data_to_file and before training with patch_shape set.
+    :param in_file: hdf5 file written by write_data_to_file.
+    :param out_file: Where the rechunked hdf5 file will be written to.
+    :param patch_shape: shape of the patches that will be used for training.
+    :param max_chunk_bytes: upper limit on the size of a chunk. Default is 1 MiB.
+    :return: Location of the rechunked hdf5 file.
+    """
+    filters = tables.Filters(complevel=5, complib='blosc')
+    with tables.open_file(in_file, "r") as src, tables.open_file(out_file, "w") as dst:
+        for node in src.root:
+            if node.name not in ("data", "truth"):
+                node.copy(dst.root)
+                continue
+            chunkshape = get_patch_chunkshape(patch_shape, node.dtype.itemsize, max_chunk_bytes=max_chunk_bytes)
+            storage = dst.create_carray(dst.root, node.name, atom=node.atom, shape=node.shape, filters=filters,
+                                        chunkshape=chunkshape)
+            for index in range(node.shape[0]):
+                storage[index] = node[index]
+    return out_file
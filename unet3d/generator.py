@@ -3,7 +3,6 @@
   @ Author: Zhao YaChen
 '''
 import os
-import copy
 from random import shuffle
 import itertools
 
@@ -148,7 +147,7 @@ def data_generator(data_file, index_list, batch_size=1, n_labels=1, labels=None,
             index_list = create_patch_index_list(orig_index_list, data_file.root.data.shape[-3:], patch_shape,
                                                  patch_overlap, patch_start_offset)
         else:
-            index_list = copy.copy(orig_index_list)
+            index_list = orig_index_list[:]
 
         if shuffle_index_list:
             shuffle(index_list)
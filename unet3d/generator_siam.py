@@ -1,23 +1,46 @@
+"""
+Data generators for the siamese model, which reads the same subjects from two hdf5 data files.
+When training on patches, the data files should first be rechunked with unet3d.data.rechunk_for_patches so that each
+patch read only touches the hdf5 chunks of that patch, and opened with unet3d.data.open_data_file, which enlarges the
+chunk cache.
+"""
 import os
-import copy
 from random import shuffle
 import itertools
+import functools
+import numbers
+import threading
+import queue
+import weakref
 
 import numpy as np
 
+from unet3d.data import open_data_file
 from unet3d.utils import pickle_dump, pickle_load
-from unet3d.utils.patches import compute_patch_indices, get_random_nd_index, get_patch_from_3d_data
+from unet3d.utils.patches import compute_patch_indices, get_patch_from_hdf5, get_nonblank_patches
 from unet3d.augment import augment_data, random_permutation_x_y
 
+# pytables is not thread safe, not even through separate file handles, so every read from the data files goes through
+# this lock. It is reentrant so that functions holding it can call each other.
+_hdf5_lock = threading.RLock()
+
 
 
 def get_training_and_validation_generators(data_file0, data_file1, batch_size, n_labels, training_keys_file, validation_keys_file,
                                            data_split=0.8, overwrite=False, labels=None, augment=False,
                                            augment_flip=True, augment_distortion_factor=0.25, patch_shape=None,
                                            validation_patch_overlap=0, training_patch_start_offset=None,
-                                           validation_batch_size=None, skip_blank=True, permute=False):
+                                           validation_batch_size=None, skip_blank=True, permute=False, max_prefetch=0,
+                                           n_workers=0, use_numba=False):
     """
     Creates the training and validation generators that can be used when training the model.
+    :param use_numba: If True and numba is installed, the samples are normalized by a parallel numba kernel instead of
+    numpy (see _prep_sample).
+    :param n_workers: Number of worker processes each generator uses to read, augment and normalize samples in
+    parallel. If 0, the samples are prepared in the generator's own thread.
+    :param max_prefetch: Number of batches each generator builds ahead of time in a background thread. The threads read
+    through the given file handles one at a time. The default of 0 builds the batches synchronously, which is enough
+    when Keras' fit_generator already runs the generator in its own thread.
     :param skip_blank: If True, any blank (all-zero) label images/patches will be skipped by the data generator.
     :param validation_batch_size: Batch size for the validation data.
     :param training_patch_start_offset: Tuple of length 3 containing integer values. Training data will randomly be
@@ -57,43 +80,93 @@ def get_training_and_validation_generators(data_file0, data_file1, batch_size, n
                                                           training_file=training_keys_file,
                                                           validation_file=validation_keys_file)
 
-    training_generator = data_generator(data_file0, data_file1, training_list,
-                                        batch_size=batch_size,
-                                        n_labels=n_labels,
-                                        labels=labels,
-                                        augment=augment,
-                                        augment_flip=augment_flip,
-                                        augment_distortion_factor=augment_distortion_factor,
-                                        patch_shape=patch_shape,
-                                        patch_overlap=0,
-                                        patch_start_offset=training_patch_start_offset,
-                                        shuffle_index_list=True,
-                                        skip_blank=skip_blank,
-                                        permute=permute)
-    validation_generator = data_generator(data_file0, data_file1, validation_list,
-                                          batch_size=validation_batch_size,
-                                          n_labels=n_labels,
-                                          labels=labels,
-                                          patch_shape=patch_shape,
-                                          patch_overlap=validation_patch_overlap,
-                                          skip_blank=skip_blank)
+    training_kwargs = dict(batch_size=batch_size,
+                           n_labels=n_labels,
+                           labels=labels,
+                           augment=augment,
+                           augment_flip=augment_flip,
+                           augment_distortion_factor=augment_distortion_factor,
+                           patch_shape=patch_shape,
+                           patch_overlap=0,
+                           patch_start_offset=training_patch_start_offset,
+                           shuffle_index_list=True,
+                           skip_blank=skip_blank,
+                           permute=permute,
+                           n_workers=n_workers,
+                           use_numba=use_numba)
+    validation_kwargs = dict(batch_size=validation_batch_size,
+                             n_labels=n_labels,
+                             labels=labels,
+                             patch_shape=patch_shape,
+                             patch_overlap=validation_patch_overlap,
+                             skip_blank=skip_blank,
+                             n_workers=n_workers,
+                             use_numba=use_numba)
 
     # Set the number of training and testing samples per epoch correctly
-    num_training_steps = get_number_of_steps(get_number_of_patches(data_file0, training_list, patch_shape,
+    num_training_steps = get_number_of_steps(get_number_of_patches(data_file0, data_file1, training_list, patch_shape,
                                                                    skip_blank=skip_blank,
                                                                    patch_start_offset=training_patch_start_offset,
                                                                    patch_overlap=0), batch_size)
     print("Number of training steps: ", num_training_steps)
 
-    num_validation_steps = get_number_of_steps(get_number_of_patches(data_file0, validation_list, patch_shape,
+    num_validation_steps = get_number_of_steps(get_number_of_patches(data_file0, data_file1, validation_list,
+                                                                     patch_shape,
                                                                      skip_blank=skip_blank,
                                                                      patch_overlap=validation_patch_overlap),
                                                validation_batch_size)
     print("Number of validation steps: ", num_validation_steps)
 
+    training_generator = data_generator(data_file0, data_file1, training_list, **training_kwargs)
+    validation_generator = data_generator(data_file0, data_file1, validation_list, **validation_kwargs)
+    if max_prefetch:
+        # the prefetch threads share the file handles, their reads are serialized by _hdf5_lock
+        training_generator = BackgroundGenerator(training_generator, max_prefetch=max_prefetch)
+        validation_generator = BackgroundGenerator(validation_generator, max_prefetch=max_prefetch)
+
     return training_generator, validation_generator, num_training_steps, num_validation_steps
 
 
+class BackgroundGenerator(threading.Thread):
+    """
+    Runs a generator in a daemon thread and buffers up to max_prefetch of its items in a queue, so that the next batch
+    is built while the model trains on the current one. Reading the hdf5 files and the numpy work release the GIL, so a
+    thread is enough to overlap batch assembly with training. The thread is started by the first call to next(), so
+    that a generator that is not used yet does not read from its files.
+    """
+    _sentinel = object()
+
+    def __init__(self, generator, max_prefetch=4):
+        threading.Thread.__init__(self)
+        self.queue = queue.Queue(maxsize=max_prefetch)
+        self.generator = generator
+        self.daemon = True
+
+    def run(self):
+        try:
+            for item in self.generator:
+                self.queue.put(item)
+        except Exception as error:
+            self.queue.put(error)
+        self.queue.put(self._sentinel)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self.ident is None:
+            self.start()
+        item = self.queue.get()
+        if item is self._sentinel:
+            self.queue.put(self._sentinel)
+            raise StopIteration
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    next = __next__
+
+
 def get_number_of_steps(n_samples, batch_size):
     if n_samples <= batch_size:
         return n_samples
@@ -121,23 +194,27 @@ def get_validation_split(data_file, training_file, validation_file, data_split=0
         #sample_list = list(range(nb_samples))
         #training_list, validation_list = split_list(sample_list, split=data_split)
 
-        test_listA  = list(range(10, 30))
-        train_listA1  = list(range(0, 10))
-        train_listA2  = list(range(30, 42))
+        test_listA = np.arange(10, 30)
+        train_listA1 = np.arange(0, 10)
+        train_listA2 = np.arange(30, 42)
 
-        test_listB  = list(range(52, 72))
-        train_listB1  = list(range(42, 52))
-        train_listB2  = list(range(72, 239))
+        test_listB = np.arange(52, 72)
+        train_listB1 = np.arange(42, 52)
+        train_listB2 = np.arange(72, 239)
 
-        test_listC  = list(range(249, 269))
-        train_listC1  = list(range(239, 249))
-        train_listC2  = list(range(269, 299))
-    
-        training_list = train_listA1 + train_listA2 + train_listB1 + train_listB2 + [train_listB2[-1]] + train_listC1 * 5 + train_listC2 * 5
-        validation_list = test_listA + test_listB + test_listC
+        test_listC = np.arange(249, 269)
+        train_listC1 = np.arange(239, 249)
+        train_listC2 = np.arange(269, 299)
+
+        # class C subjects are oversampled 5 times
+        training_list = np.concatenate([train_listA1, train_listA2, train_listB1, train_listB2, train_listB2[-1:],
+                                        np.tile(train_listC1, 5), np.tile(train_listC2, 5)])
+        validation_list = np.concatenate([test_listA, test_listB, test_listC])
 
-        shuffle(training_list)
+        np.random.shuffle(training_list)
         #shuffle(validation_list)
+        training_list = training_list.tolist()
+        validation_list = validation_list.tolist()
         pickle_dump(training_list, training_file)
         pickle_dump(validation_list, validation_file)
         return training_list, validation_list
@@ -159,69 +236,304 @@ def split_list(input_list, split=0.8, shuffle_list=True):
 
 def data_generator(data_file0, data_file1, index_list, batch_size=1, n_labels=1, labels=None, augment=False, augment_flip=True,
                    augment_distortion_factor=0.25, patch_shape=None, patch_overlap=0, patch_start_offset=None,
-                   shuffle_index_list=False, skip_blank=True, permute=False):
+                   shuffle_index_list=False, skip_blank=True, permute=False, n_workers=0, use_numba=False):
+    add_data_kwargs = dict(augment=augment, augment_flip=augment_flip,
+                           augment_distortion_factor=augment_distortion_factor, patch_shape=patch_shape,
+                           skip_blank=skip_blank, permute=permute, n_labels=n_labels, use_numba=use_numba)
+    if n_workers:
+        yield from parallel_data_generator(data_file0, data_file1, index_list, batch_size=batch_size,
+                                           n_workers=n_workers, labels=labels, patch_overlap=patch_overlap,
+                                           patch_start_offset=patch_start_offset,
+                                           shuffle_index_list=shuffle_index_list, **add_data_kwargs)
+        return
+
     orig_index_list = index_list
+    data_buffers, subject_labels = get_sample_buffers(data_file0, data_file1, patch_shape=patch_shape)
+    x_batch, y_batch = get_batch_buffers(data_file0, batch_size, patch_shape=patch_shape)
+    n_samples = 0
     while True:
-        x_list = [[], []]
-        y_list = [[], [], []]
-        if patch_shape:
-            index_list = create_patch_index_list(orig_index_list, data_file.root.data.shape[-3:], patch_shape,
-                                                 patch_overlap, patch_start_offset)
-        else:
-            index_list = copy.copy(orig_index_list)
+        index_list, order = get_epoch_order(orig_index_list, data_file0, patch_shape, patch_overlap,
+                                            patch_start_offset, shuffle_index_list)
+        for position, list_index in enumerate(order, 1):
+            index = index_list[list_index]
+            if add_data(x_batch, y_batch, n_samples, data_file0, data_file1, index, data_buffers=data_buffers,
+                        subject_labels=subject_labels, **add_data_kwargs):
+                n_samples += 1
+
+            if n_samples == batch_size or (position == len(order) and n_samples > 0):
+                # copy the filled slots out so that the buffers can be refilled while the batch is in use
+                yield convert_data([x[:n_samples].copy() for x in x_batch], [y[:n_samples].copy() for y in y_batch],
+                                   n_labels=n_labels, labels=labels)
+                n_samples = 0
+
+
+def parallel_data_generator(data_file0, data_file1, index_list, batch_size=1, n_workers=1, labels=None,
+                            patch_overlap=0, patch_start_offset=None, shuffle_index_list=False, **add_data_kwargs):
+    """
+    Same as data_generator, but add_data runs in a pool of worker processes. Each worker opens its own handles to the
+    data files and writes its samples into batch arrays held in shared memory, which are copied out once a batch is
+    complete.
+    The shared memory is released when the generator is closed or garbage collected. If the interpreter exits while
+    the generator is suspended, for example in the daemon thread of a BackgroundGenerator that is blocked on a full
+    queue, the blocks are unlinked at exit instead.
+    Requires python 3.8 or later for multiprocessing.shared_memory.
+    :param n_workers: number of worker processes.
+    :param add_data_kwargs: augmentation, patch_shape, skip_blank, permute, n_labels and use_numba arguments passed to
+    add_data.
+    """
+    # imported here so that the serial generators keep working on python versions without shared_memory
+    import multiprocessing
+    from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+    from multiprocessing.shared_memory import SharedMemory
+
+    patch_shape = add_data_kwargs["patch_shape"]
+    batch_specs = get_batch_specs(data_file0, batch_size, patch_shape=patch_shape)
+    shared_memory = [SharedMemory(create=True, size=max(int(np.prod(shape)) * np.dtype(dtype).itemsize, 1))
+                     for shape, dtype in batch_specs]
+    batch = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for (shape, dtype), block in zip(batch_specs, shared_memory)]
+    # spawn rather than fork, as hdf5 file handles are not safe to share with forked processes
+    executor = ProcessPoolExecutor(max_workers=n_workers, mp_context=multiprocessing.get_context("spawn"),
+                                   initializer=_init_worker,
+                                   initargs=(data_file0.filename, data_file1.filename,
+                                             [block.name for block in shared_memory], batch_specs, add_data_kwargs))
+    release_shared_memory = weakref.finalize(executor, _release_shared_memory, shared_memory)
+    try:
+        while True:
+            epoch_index_list, order = get_epoch_order(index_list, data_file0, patch_shape, patch_overlap,
+                                                      patch_start_offset, shuffle_index_list)
+            positions = iter(order)
+            free_slots = list(range(batch_size))
+            filled_slots = list()
+            pending = dict()
+            while True:
+                while free_slots:
+                    list_index = next(positions, None)
+                    if list_index is None:
+                        break
+                    slot = free_slots.pop()
+                    pending[executor.submit(_worker_add_data, slot, epoch_index_list[list_index])] = slot
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    slot = pending.pop(future)
+                    if future.result():
+                        filled_slots.append(slot)
+                    else:
+                        free_slots.append(slot)
+                if len(filled_slots) == batch_size:
+                    yield convert_data([x[filled_slots] for x in batch[:2]], [y[filled_slots] for y in batch[2:]],
+                                       n_labels=add_data_kwargs["n_labels"], labels=labels)
+                    free_slots, filled_slots = filled_slots, list()
+            if filled_slots:
+                yield convert_data([x[filled_slots] for x in batch[:2]], [y[filled_slots] for y in batch[2:]],
+                                   n_labels=add_data_kwargs["n_labels"], labels=labels)
+    finally:
+        executor.shutdown()
+        del batch
+        release_shared_memory()
+
+
+def _release_shared_memory(shared_memory):
+    for block in shared_memory:
+        try:
+            block.close()
+        except BufferError:
+            # the batch arrays of a generator that is still suspended at exit view the block, unlinking it is enough
+            pass
+        block.unlink()
+
+
+_worker_state = dict()
+
+
+def _init_worker(filename0, filename1, shared_memory_names, batch_specs, add_data_kwargs):
+    from multiprocessing.shared_memory import SharedMemory
+
+    if add_data_kwargs["use_numba"] and _get_prep_sample_kernel() is not None:
+        import numba
+
+        # every worker prepares one sample at a time, so the workers would oversubscribe the cores with numba threads
+        numba.set_num_threads(1)
+    data_file0 = open_data_file(filename0)
+    data_file1 = open_data_file(filename1)
+    shared_memory = [SharedMemory(name=name) for name in shared_memory_names]
+    batch = [np.ndarray(shape, dtype=dtype, buffer=block.buf) for (shape, dtype), block in zip(batch_specs, shared_memory)]
+    data_buffers, subject_labels = get_sample_buffers(data_file0, data_file1, patch_shape=add_data_kwargs["patch_shape"])
+    _worker_state.update(data_file0=data_file0, data_file1=data_file1, shared_memory=shared_memory,
+                         x_batch=batch[:2], y_batch=batch[2:], data_buffers=data_buffers,
+                         subject_labels=subject_labels, add_data_kwargs=add_data_kwargs)
+
+
+def _worker_add_data(slot, index):
+    state = _worker_state
+    return add_data(state["x_batch"], state["y_batch"], slot, state["data_file0"], state["data_file1"], index,
+                    data_buffers=state["data_buffers"], subject_labels=state["subject_labels"],
+                    **state["add_data_kwargs"])
+
+
+def get_epoch_order(index_list, data_file, patch_shape, patch_overlap, patch_start_offset, shuffle_index_list):
+    """
+    Returns the index list of an epoch and the order in which to visit its positions.
+    """
+    if patch_shape:
+        index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape,
+                                             patch_overlap, patch_start_offset)
+
+    # walk a permutation of the positions rather than copying and popping the index list every epoch
+    if shuffle_index_list:
+        order = np.random.permutation(len(index_list))
+    else:
+        order = range(len(index_list))
+    return index_list, order
+
+
+def get_sample_buffers(data_file0, data_file1, patch_shape=None):
+    """
+    Allocates the per-sample read buffers of the two data files and decodes the subject labels that add_data uses.
+    :return: data buffers (None when reading patches), subject labels
+    """
+    if patch_shape:
+        data_buffers = None
+    else:
+        data_buffers = (get_data_buffer(data_file0), get_data_buffer(data_file1))
+    subject_labels = get_subject_labels(data_file0)
+    if __debug__:
+        assert np.array_equal(subject_labels, get_subject_labels(data_file1)), \
+            "The class labels of the subjects differ between the data files."
+    return data_buffers, subject_labels
 
-        if shuffle_index_list:
-            shuffle(index_list)
-        while len(index_list) > 0:
-            index = index_list.pop()
-            add_data(x_list, y_list, data_file0, data_file1, index, augment=augment, augment_flip=augment_flip,
-                     augment_distortion_factor=augment_distortion_factor, patch_shape=patch_shape,
-                     skip_blank=skip_blank, permute=permute)
 
-            if len(y_list[0]) == batch_size or (len(index_list) == 0 and len(y_list[0]) > 0):
-                yield convert_data(x_list, y_list, n_labels=n_labels, labels=labels)
+def get_batch_specs(data_file, batch_size, patch_shape=None):
+    """
+    Returns the shapes and dtypes of the two float32 data batches, the label batch and the two truth batches.
+    :param data_file: pytables hdf5 data file
+    :param batch_size: number of samples per batch.
+    :param patch_shape: Shape of the patches in the batch. If None, the batch will hold whole images.
+    :return: list of (shape, dtype) tuples
+    """
+    image_shape = tuple(patch_shape) if patch_shape else data_file.root.data.shape[-3:]
+    data_shape = (batch_size, data_file.root.data.shape[1]) + tuple(image_shape)
+    truth_shape = (batch_size, 1) + tuple(image_shape)
+    truth_dtype = np.dtype(data_file.root.truth.dtype)
+    return [(data_shape, np.dtype(np.float32)), (data_shape, np.dtype(np.float32)),
+            ((batch_size,), np.dtype(np.int64)), (truth_shape, truth_dtype), (truth_shape, truth_dtype)]
 
-                x_list = [[], []]
-                y_list = [[], [], []]
 
+def get_batch_buffers(data_file, batch_size, patch_shape=None):
+    """
+    Allocates the arrays that data_generator assembles its batches in.
+    :param data_file: pytables hdf5 data file
+    :param batch_size: number of samples per batch.
+    :param patch_shape: Shape of the patches in the batch. If None, the batch will hold whole images.
+    :return: list of the two float32 data batches, list of the label batch and the two truth batches
+    """
+    batch = [np.empty(shape, dtype=dtype) for shape, dtype in get_batch_specs(data_file, batch_size, patch_shape)]
+    return batch[:2], batch[2:]
 
-def get_number_of_patches(data_file, index_list, patch_shape=None, patch_overlap=0, patch_start_offset=None,
-                          skip_blank=True):
+
+def get_number_of_patches(data_file0, data_file1, index_list, patch_shape=None, patch_overlap=0,
+                          patch_start_offset=None, skip_blank=True):
+    """
+    Counts the samples or patches that data_generator will return for the index list, skipping the ones where the
+    truth of both data files is blank if skip_blank is True. Only the truth arrays are read, and samples that are
+    blank as a whole are looked up in the cache written by get_nonblank_samples.
+    """
     if patch_shape:
-        index_list = create_patch_index_list(index_list, data_file.root.data.shape[-3:], patch_shape, patch_overlap,
+        index_list = create_patch_index_list(index_list, data_file0.root.data.shape[-3:], patch_shape, patch_overlap,
                                              patch_start_offset)
+        if not skip_blank:
+            return len(index_list)
+        nonblank_samples = get_nonblank_samples(data_file0) | get_nonblank_samples(data_file1)
         count = 0
-        for index in index_list:
-            x_list = list()
-            y_list = list()
-            add_data(x_list, y_list, data_file, index, skip_blank=skip_blank, patch_shape=patch_shape)
-            if len(x_list) > 0:
-                count += 1
+        for index, patches in itertools.groupby(index_list, key=lambda item: item[0]):
+            if not nonblank_samples[index]:
+                continue
+            patch_indices = np.asarray([patch_index for _, patch_index in patches])
+            nonblank_patches = np.zeros(len(patch_indices), dtype=bool)
+            for data_file in (data_file0, data_file1):
+                with _hdf5_lock:
+                    truth = data_file.root.truth[index, 0]
+                nonblank_patches |= get_nonblank_patches(truth, patch_indices, patch_shape)
+            count += int(np.sum(nonblank_patches))
         return count
+    elif skip_blank:
+        nonblank_samples = get_nonblank_samples(data_file0) | get_nonblank_samples(data_file1)
+        return int(np.sum(nonblank_samples[index_list]))
     else:
         return len(index_list)
 
 
+def get_nonblank_samples(data_file):
+    """
+    Returns for each sample whether its truth has any non-zero values. The result is cached in a
+    <data file>_nonblank_cache.npz file next to the data file together with the size, modification time and number of
+    samples of the data file, and is only reused while all of them match. If the cache file cannot be written, the
+    computed result is returned without caching it.
+    :param data_file: pytables hdf5 data file
+    :return: boolean numpy array with one value per sample
+    """
+    cache_file = data_file.filename + "_nonblank_cache.npz"
+    truth = data_file.root.truth
+    stat = os.stat(data_file.filename)
+    source = np.asarray([stat.st_size, stat.st_mtime_ns, truth.shape[0]], dtype=np.int64)
+    try:
+        with np.load(cache_file) as cache:
+            if np.array_equal(cache["source"], source) and cache["nonblank_samples"].shape == (truth.shape[0],):
+                return cache["nonblank_samples"]
+    except (OSError, KeyError, ValueError):
+        # no cache yet, or not one that can be read
+        pass
+    with _hdf5_lock:
+        nonblank_samples = np.asarray([np.any(truth[index] != 0) for index in range(truth.shape[0])], dtype=bool)
+    try:
+        np.savez(cache_file, nonblank_samples=nonblank_samples, source=source)
+    except OSError:
+        # the directory of the data file may be read-only, in which case the samples are checked again next time
+        pass
+    return nonblank_samples
+
+
 def create_patch_index_list(index_list, image_shape, patch_shape, patch_overlap, patch_start_offset=None):
-    patch_index = list()
-    for index in index_list:
-        if patch_start_offset is not None:
-            random_start_offset = np.negative(get_random_nd_index(patch_start_offset))
-            patches = compute_patch_indices(image_shape, patch_shape, overlap=patch_overlap, start=random_start_offset)
-        else:
-            patches = compute_patch_indices(image_shape, patch_shape, overlap=patch_overlap)
-        patch_index.extend(itertools.product([index], patches))
-    return patch_index
+    if patch_start_offset is not None:
+        # every random start offset shifts the same grid of patch corners, so compute the grid once and broadcast
+        # one random offset per sample over it
+        patches = compute_patch_indices(image_shape, patch_shape, overlap=patch_overlap, start=0)
+        random_start_offsets = np.stack([np.random.randint(0, max_offset + 1, size=len(index_list))
+                                         for max_offset in patch_start_offset], axis=1)
+        patches = patches[np.newaxis] - random_start_offsets[:, np.newaxis]
+        return [(index, patch) for index, index_patches in zip(index_list, patches) for patch in index_patches]
+    # the cache key has to be hashable, and numpy integers such as np.int64 are valid overlaps as well
+    if isinstance(patch_overlap, numbers.Integral):
+        patch_overlap = int(patch_overlap)
+    else:
+        patch_overlap = tuple(int(overlap) for overlap in patch_overlap)
+    patches = get_patch_indices(tuple(image_shape), tuple(patch_shape), patch_overlap)
+    return list(itertools.product(index_list, patches))
 
 
-def add_data(x_list, y_list, data_file0, data_file1, index, augment=False, augment_flip=False, augment_distortion_factor=0.25,
-             patch_shape=False, skip_blank=True, permute=False):
+@functools.lru_cache(maxsize=None)
+def get_patch_indices(image_shape, patch_shape, patch_overlap):
     """
-    Adds data from the data file to the given lists of feature and target data
+    Cached compute_patch_indices for patches without a random start offset, which are the same every epoch.
+    :return: tuple of patch corner indices
+    """
+    if not isinstance(patch_overlap, numbers.Integral):
+        patch_overlap = np.asarray(patch_overlap)
+    patches = compute_patch_indices(np.asarray(image_shape), np.asarray(patch_shape), overlap=patch_overlap)
+    return tuple(tuple(patch) for patch in patches)
+
+
+def add_data(x_batch, y_batch, slot, data_file0, data_file1, index, augment=False, augment_flip=False,
+             augment_distortion_factor=0.25, patch_shape=False, skip_blank=True, permute=False, data_buffers=None,
+             n_labels=1, subject_labels=None, use_numba=False):
+    """
+    Writes data from the data files into the given slot of the feature and target batch arrays
     :param skip_blank: Data will not be added if the truth vector is all zeros (default is True).
-    :param patch_shape: Shape of the patch to add to the data lists. If None, the whole image will be added.
-    :param x_list: list of data to which data from the data_file will be appended.
-    :param y_list: list of data to which the target data from the data_file will be appended.
+    :param patch_shape: Shape of the patch to add to the batch. If None, the whole image will be added.
+    :param x_batch: list of the two data batch arrays (see get_batch_buffers) that the normalized data will be written to.
+    :param y_batch: list of the label batch and the two truth batch arrays that the target data will be written to.
+    :param slot: index along the batch axis to write the sample to.
     :param data_file: hdf5 data file.
     :param index: index of the data file from which to extract the data.
     :param augment: if True, data will be augmented according to the other augmentation parameters (augment_flip and
@@ -231,127 +543,258 @@ def add_data(x_list, y_list, data_file0, data_file1, index, augment=False, augme
     that the data will be distorted (in a stretching or shrinking fashion). Set to None, False, or 0 to prevent the
     augmentation from distorting the data in this way.
     :param permute: will randomly permute the data (data must be 3D cube)
-    :return:
+    :param data_buffers: optional pair of arrays (see get_data_buffer) that the image data of data_file0 and data_file1
+    will be read into instead of allocating new arrays for every sample.
+    :param n_labels: Number of binary labels. If 1, the truth will be written to the batch as 0/1 values.
+    :param subject_labels: optional array (see get_subject_labels) holding the class label of every sample.
+    :param use_numba: if True, the sample is normalized by the numba kernel (see _prep_sample).
+    :return: True if the sample was written to the batch, False if it was skipped.
     """
+    data0, truth0, data1, truth1, label = get_paired_data(data_file0, data_file1, index, patch_shape=patch_shape,
+                                                          data_buffers=data_buffers, subject_labels=subject_labels)
 
-    data0, truth0, label0 = get_data_from_file(data_file0, index, patch_shape=patch_shape)
-    data1, truth1, label1 = get_data_from_file(data_file1, index, patch_shape=patch_shape)
-
-    if label0 != label1:
-        print ('label0 and label1 not equal !!!')
-        print (label0)
-        print (label1)
-        raise
+    # blank truth stays blank when augmented, so blank samples are skipped before any augmentation or normalization
+    if skip_blank and not (truth0.any() or truth1.any()):
+        return False
 
     if augment:
-        if patch_shape is not None:
-            affine0 = data_file0.root.affine[index[0]]
-            affine1 = data_file1.root.affine[index[0]]
-        else:
-            affine0 = data_file0.root.affine[index]
-            affine1 = data_file1.root.affine[index]
+        with _hdf5_lock:
+            if patch_shape is not None:
+                affine0 = data_file0.root.affine[index[0]]
+                affine1 = data_file1.root.affine[index[0]]
+            else:
+                affine0 = data_file0.root.affine[index]
+                affine1 = data_file1.root.affine[index]
         data0, truth0, data1, truth1 = augment_data(data0, data1, truth0, truth1, affine0, affine1, flip=augment_flip, scale_deviation=augment_distortion_factor)
+        if skip_blank and not (truth0.any() or truth1.any()):
+            return False
 
     if permute:
         if data.shape[-3] != data.shape[-2] or data.shape[-2] != data.shape[-1]:
             raise ValueError("To utilize permutations, data array must be in 3D cube shape with all dimensions having "
                              "the same length.")
         data, truth = random_permutation_x_y(data, truth[np.newaxis])
-    else:
-        truth0 = truth0[np.newaxis]
-        truth1 = truth1[np.newaxis]
 
-    if not skip_blank or (np.any(truth0 != 0) or np.any(truth1 != 0)):
+    # the truth is written into the channel of its batch slot, so it needs no leading channel axis
+    _prep_sample(data0, data1, truth0, truth1, out0=x_batch[0][slot], out1=x_batch[1][slot],
+                 truth_out0=y_batch[1][slot, 0], truth_out1=y_batch[2][slot, 0], binarize=n_labels == 1,
+                 use_numba=use_numba)
+    y_batch[0][slot] = label
+    return True
 
-        #data0_0_temp = data0[0,...]
-        #data0_0 = data0_0_temp[None, ...]
-        #data1_0_temp = data1[0,...]
-        #data1_0 = data1_0_temp[None, ...]
+def _normalize01(x, out=None):
+    """
+    Rescales an array to the range [0, 1] in a single subtract pass and a single in-place scale pass.
+    :param x: numpy array to rescale.
+    :param out: optional float32 array with the same shape as x that the result will be written to. If None, a new
+    array will be allocated.
+    :return: the rescaled float32 array. If x is constant, an array of zeros is returned.
+    """
+    if out is None:
+        out = np.empty(x.shape, dtype=np.float32)
+    mn = x.min()
+    rng = x.max() - mn
+    if rng == 0:
+        out.fill(0)
+        return out
+    np.subtract(x, mn, out=out, dtype=np.float32)
+    out *= np.float32(1.0) / np.float32(rng)
+    return out
+
+
+def _prep_sample(data0, data1, truth0, truth1, out0=None, out1=None, truth_out0=None, truth_out1=None,
+                 binarize=True, use_numba=False):
+    """
+    Normalizes both modalities of a sample to [0, 1] and copies both truth volumes.
+    Uses numpy by default. The numba kernel only pays off when it can spread a sample over several cores, and every
+    call to it is serialized, so it has to be enabled with use_numba.
+    :param out0: optional contiguous float32 array that the normalized data0 will be written to.
+    :param out1: optional contiguous float32 array that the normalized data1 will be written to.
+    :param truth_out0: optional contiguous array that truth0 will be written to.
+    :param truth_out1: optional contiguous array that truth1 will be written to.
+    :param binarize: if True, truth values greater than 0 will be written as 1.
+    :param use_numba: if True and numba is installed, the numba kernel is used. It is compiled on the first call.
+    :return: normalized float32 data0, normalized float32 data1, truth0, truth1
+    """
+    if truth_out0 is None:
+        truth_out0 = np.empty(np.shape(truth0), dtype=np.uint8 if binarize else np.asarray(truth0).dtype)
+    if truth_out1 is None:
+        truth_out1 = np.empty(np.shape(truth1), dtype=np.uint8 if binarize else np.asarray(truth1).dtype)
+
+    kernel = _get_prep_sample_kernel() if use_numba else None
+    if kernel is None:
+        if binarize:
+            np.greater(truth0, 0, out=truth_out0, casting="unsafe")
+            np.greater(truth1, 0, out=truth_out1, casting="unsafe")
+        else:
+            np.copyto(truth_out0, truth0, casting="unsafe")
+            np.copyto(truth_out1, truth1, casting="unsafe")
+        return _normalize01(data0, out=out0), _normalize01(data1, out=out1), truth_out0, truth_out1
 
-        data0_0 = data0
-        data1_0 = data1
+    data0 = np.ascontiguousarray(data0)
+    data1 = np.ascontiguousarray(data1)
+    if out0 is None:
+        out0 = np.empty(data0.shape, dtype=np.float32)
+    if out1 is None:
+        out1 = np.empty(data1.shape, dtype=np.float32)
+    # numba's workqueue threading layer aborts when a parallel kernel is entered from two threads at once
+    with _kernel_lock:
+        kernel(data0.reshape(-1), data1.reshape(-1),
+               np.ascontiguousarray(truth0).reshape(-1), np.ascontiguousarray(truth1).reshape(-1),
+               out0.reshape(-1), out1.reshape(-1), truth_out0.reshape(-1), truth_out1.reshape(-1), binarize)
+    return out0, out1, truth_out0, truth_out1
 
-        if data0_0.min() == data0_0.max():
-            data0_0 = data0_0 - data0_0
-        else:                
-            data0_0 = (data0_0-data0_0.min())/(data0_0.max()-data0_0.min())
 
-        if data1_0.min() == data1_0.max():
-            data1_0 = data1_0 - data1_0
-        else:                
-            data1_0 = (data1_0-data1_0.min())/(data1_0.max()-data1_0.min())
+_kernel_lock = threading.Lock()
 
-        x_list[0].append(data0_0)
-        x_list[1].append(data1_0)
 
-        #x_list.append([data0, data1, truth0, truth1])
-        y_list[0].append(label0)
-        y_list[1].append(truth0)
-        y_list[2].append(truth1)
-    else:
-        #print ('here')
-        #print (np.any(truth0 != 0))
-        #print (np.any(truth1 != 0))
-        #raise
-        pass
+@functools.lru_cache(maxsize=None)
+def _get_prep_sample_kernel():
+    """
+    Imports numba and builds the kernel of _prep_sample on first use, so that importing this module and starting the
+    worker processes does not pay for it.
+    :return: the kernel, or None if numba is not installed.
+    """
+    try:
+        from numba import njit, prange
+    except ImportError:
+        return None
+
+    @njit(parallel=True, fastmath=True, cache=True)
+    def prep_sample_kernel(data0, data1, truth0, truth1, out0, out1, truth_out0, truth_out1, binarize):
+        mn0 = data0[0]
+        mx0 = data0[0]
+        for i in prange(data0.size):
+            mn0 = min(mn0, data0[i])
+            mx0 = max(mx0, data0[i])
+        mn1 = data1[0]
+        mx1 = data1[0]
+        for i in prange(data1.size):
+            mn1 = min(mn1, data1[i])
+            mx1 = max(mx1, data1[i])
+        for i in prange(truth0.size):
+            if binarize:
+                truth_out0[i] = 1 if truth0[i] > 0 else 0
+            else:
+                truth_out0[i] = truth0[i]
+        for i in prange(truth1.size):
+            if binarize:
+                truth_out1[i] = 1 if truth1[i] > 0 else 0
+            else:
+                truth_out1[i] = truth1[i]
+
+        # keep the rescale in float32 so that float32 inputs are not upcast to float64 inside the loop
+        offset0 = np.float32(mn0)
+        offset1 = np.float32(mn1)
+        scale0 = np.float32(0.0) if mx0 == mn0 else np.float32(1.0) / (np.float32(mx0) - offset0)
+        scale1 = np.float32(0.0) if mx1 == mn1 else np.float32(1.0) / (np.float32(mx1) - offset1)
+        for i in prange(data0.size):
+            out0[i] = (np.float32(data0[i]) - offset0) * scale0
+        for i in prange(data1.size):
+            out1[i] = (np.float32(data1[i]) - offset1) * scale1
+
+    return prep_sample_kernel
+
+
+def get_data_buffer(data_file):
+    """
+    Allocates an array that a single sample of the data file's image data can be read into.
+    :param data_file: pytables hdf5 data file
+    :return: empty numpy array with the shape and dtype of data_file.root.data[index]
+    """
+    return np.empty(data_file.root.data.shape[1:], dtype=data_file.root.data.dtype)
+
 
-def get_data_from_file(data_file, index, patch_shape=None):
+def get_subject_label(subject_id):
+    """
+    Decodes the class label of a subject id such as b"<name>-C1": 1 for class C subjects and 0 for class A or B
+    subjects.
+    :param subject_id: subject id as stored in data_file.root.subject_ids.
+    :return: integer class label
+    """
+    if isinstance(subject_id, bytes):
+        subject_id = subject_id.decode()
+    ids_AC = subject_id.split('-')[-1][0]
+    if ids_AC == 'C':
+        return 1
+    elif ids_AC == 'A' or ids_AC == 'B':
+        return 0
+    raise ValueError("Subject id '{}' is not of class A, B or C.".format(subject_id))
+
+
+def get_subject_labels(data_file):
+    """
+    Decodes the class labels of all the subjects in the data file once, so that they can be looked up by index.
+    :param data_file: pytables hdf5 data file
+    :return: numpy int8 array with the class label of every sample
+    """
+    with _hdf5_lock:
+        subject_ids = data_file.root.subject_ids[:]
+    return np.asarray([get_subject_label(subject_id) for subject_id in subject_ids], dtype=np.int8)
+
+
+def get_paired_data(data_file0, data_file1, index, patch_shape=None, data_buffers=None, subject_labels=None):
+    """
+    Reads a sample from both data files. Both files hold the same subjects, so the class label is only resolved from
+    data_file0.
+    :param data_buffers: optional pair of arrays (see get_data_buffer) that the image data will be read into.
+    :param subject_labels: optional array (see get_subject_labels) holding the class label of every sample.
+    :return: data0, truth0, data1, truth1, label
+    """
+    if data_buffers is None:
+        data_buffers = (None, None)
+    data0, truth0, label = get_data_from_file(data_file0, index, patch_shape=patch_shape, out=data_buffers[0],
+                                              subject_labels=subject_labels)
+    data1, truth1 = read_data_from_file(data_file1, index, patch_shape=patch_shape, out=data_buffers[1])
+    if __debug__ and subject_labels is None:
+        sample_index = index[0] if patch_shape else index
+        with _hdf5_lock:
+            subject_id = data_file1.root.subject_ids[sample_index]
+        assert label == get_subject_label(subject_id), \
+            "The class labels of sample {} differ between the data files.".format(sample_index)
+    return data0, truth0, data1, truth1, label
+
+
+def get_data_from_file(data_file, index, patch_shape=None, out=None, subject_labels=None):
+    x, y = read_data_from_file(data_file, index, patch_shape=patch_shape, out=out)
     if patch_shape:
-        index, patch_index = index
-        data, truth = get_data_from_file(data_file, index, patch_shape=None)
-        x = get_patch_from_3d_data(data, patch_shape, patch_index)
-        y = get_patch_from_3d_data(truth, patch_shape, patch_index)
+        index = index[0]
+    if subject_labels is None:
+        with _hdf5_lock:
+            subject_id = data_file.root.subject_ids[index]
+        label = get_subject_label(subject_id)
     else:
-        x, y = data_file.root.data[index], data_file.root.truth[index, 0]
-        ids = data_file.root.subject_ids[index]
-        ids = ids.decode()
-        ids_AC = ids.split('-')[-1][0]
-        if ids_AC == 'C':
-            label = 1
-        elif ids_AC == 'A' or ids_AC == 'B':
-            label = 0
-        else:
-            print ('not A or B, C !!!')
-            raise
+        label = subject_labels[index]
     return x, y, label
 
-'''
-def convert_data(x_list, y_list, n_labels=1, labels=None):
-
-    x = [np.asarray(i) for i in x_list]
-    #x = np.asarray(x_list)
-    #x = x_list
-    #y = np.asarray(y_list)
-    y = [np.asarray(i) for i in y_list]
-    y[0] = list(y[0])
-
-    if n_labels == 1:
-        y[1][y[1] > 0] = 1
-        y[2][y[2] > 0] = 1
-    elif n_labels > 1:
-        y = get_multi_class_labels(y, n_labels=n_labels, labels=labels)
 
+def read_data_from_file(data_file, index, patch_shape=None, out=None):
+    with _hdf5_lock:
+        if patch_shape:
+            index, patch_index = index
+            x = get_patch_from_hdf5(data_file.root.data, index, patch_shape, patch_index)
+            y = get_patch_from_hdf5(data_file.root.truth, index, patch_shape, patch_index)[0]
+        else:
+            if out is None:
+                x = data_file.root.data[index]
+            else:
+                # read the sample straight into the caller's buffer instead of allocating a new array
+                data_file.root.data.read(start=index, stop=index + 1, out=out[np.newaxis])
+                x = out
+            y = data_file.root.truth[index, 0]
     return x, y
-'''
-
-def convert_data(x_list, y_list, n_labels=1, labels=None):
-
-    x = [np.asarray(i) for i in x_list]
-    #x = np.asarray(x_list)
-    #x = x_list
-    #y = np.asarray(y_list)
-    y = [np.asarray(i) for i in y_list]
-    #y[0] = list(y[0])
-
-    if n_labels == 1:
-        y[1][y[1] > 0] = 1
-        y[2][y[2] > 0] = 1
-    elif n_labels > 1:
-        y = get_multi_class_labels(y, n_labels=n_labels, labels=labels)
-    
-    #print (type(y[0]))
-    #raise
-    #return x[0], y[0]
+
+def convert_data(x, y, n_labels=1, labels=None):
+    """
+    Converts the truth batches of y to one binary label map per label. Single label truth is already binarized by
+    add_data.
+    :param x: list of the two data batches.
+    :param y: list of the label batch and the two truth batches with shape (n_samples, 1, ...).
+    :return: x, y
+    """
+    if n_labels > 1:
+        y[1] = get_multi_class_labels(y[1], n_labels=n_labels, labels=labels)
+        y[2] = get_multi_class_labels(y[2], n_labels=n_labels, labels=labels)
     return x, y
 
 def get_multi_class_labels(data, n_labels, labels=None):
@@ -362,11 +805,9 @@ def get_multi_class_labels(data, n_labels, labels=None):
     :param labels: integer values of the labels.
     :return: binary numpy array of shape: (n_samples, n_labels, ...)
     """
-    new_shape = [data.shape[0], n_labels] + list(data.shape[2:])
-    y = np.zeros(new_shape, np.int8)
-    for label_index in range(n_labels):
-        if labels is not None:
-            y[:, label_index][data[:, 0] == labels[label_index]] = 1
-        else:
-            y[:, label_index][data[:, 0] == (label_index + 1)] = 1
-    return y
+    if labels is None:
+        labels = np.arange(1, n_labels + 1)
+    # keep the dtype of the labels, casting them to the dtype of the data would wrap labels that do not fit in it
+    labels = np.asarray(labels[:n_labels]).reshape((1, n_labels) + (1,) * (data.ndim - 2))
+    # a single broadcast comparison against all the labels instead of one pass over the data per label
+    return np.equal(data[:, 0:1], labels).astype(np.int8, copy=False)
@@ -1,3 +1,5 @@
+import itertools
+
 import numpy as np
 
 
@@ -52,6 +54,61 @@ def get_patch_from_3d_data(data, patch_shape, patch_index):
                 patch_index[2]:patch_index[2]+patch_shape[2]]
 
 
+def get_patch_from_hdf5(dataset, index, patch_shape, patch_index):
+    """
+    Returns a patch of a single sample by reading only the hyperslab of the patch from an hdf5 dataset, rather than
+    reading the whole volume and slicing the patch out of it.
+    :param dataset: pytables/h5py dataset with the samples along the first axis and the image along the last 3 axes.
+    :param index: index of the sample in the dataset.
+    :param patch_shape: shape/size of the patch.
+    :param patch_index: corner index of the patch.
+    :return: numpy array of shape dataset.shape[1:-3] + patch_shape. Parts of the patch outside of the image are
+    padded with the edge values, as in get_patch_from_3d_data.
+    """
+    patch_index = np.asarray(patch_index, dtype=int)
+    patch_shape = np.asarray(patch_shape, dtype=int)
+    image_shape = np.asarray(dataset.shape[-3:])
+    # read at least the nearest edge voxel, so that patches lying entirely outside of the image are padded from it
+    start = np.clip(patch_index, 0, image_shape - 1)
+    stop = np.clip(patch_index + patch_shape, start + 1, image_shape)
+    selection = ((int(index),) + (slice(None),) * (len(dataset.shape) - 4)
+                 + tuple(slice(int(first), int(last)) for first, last in zip(start, stop)))
+    patch = dataset[selection]
+    pad_before = np.maximum(start - patch_index, 0)
+    pad_after = np.maximum(patch_index + patch_shape - stop, 0)
+    if np.any(pad_before) or np.any(pad_after):
+        pad_args = [[0, 0]] * (patch.ndim - 3) + np.stack([pad_before, pad_after], axis=1).tolist()
+        patch = np.pad(patch, pad_args, mode="edge")
+        # the padded read starts at the smaller of the patch corner and the read start
+        offset = patch_index - np.minimum(patch_index, start)
+        patch = patch[(Ellipsis,) + tuple(slice(int(first), int(first + length))
+                                          for first, length in zip(offset, patch_shape))]
+    return patch
+
+
+def get_nonblank_patches(data, patch_indices, patch_shape):
+    """
+    Checks which patches of a 3D array contain any non-zero values, using a summed volume table so that the array is
+    traversed once regardless of the number of patches.
+    :param data: 3D numpy array.
+    :param patch_indices: array of patch corner indices with shape (n_patches, 3).
+    :param patch_shape: shape/size of the patches.
+    :return: boolean numpy array of length n_patches. Parts of a patch outside of the image count as the nearest edge
+    values, as in get_patch_from_3d_data.
+    """
+    table = np.zeros(np.add(data.shape, 1), dtype=np.int64)
+    table[1:, 1:, 1:] = np.cumsum(np.cumsum(np.cumsum(data != 0, axis=0), axis=1), axis=2)
+    patch_indices = np.asarray(patch_indices, dtype=int).reshape(-1, 3)
+    image_shape = np.asarray(data.shape)
+    start = np.clip(patch_indices, 0, image_shape - 1)
+    stop = np.clip(patch_indices + np.asarray(patch_shape), start + 1, image_shape)
+    total = np.zeros(len(patch_indices), dtype=np.int64)
+    for corner in itertools.product((0, 1), repeat=3):
+        index = tuple(np.where(corner[axis], stop[:, axis], start[:, axis]) for axis in range(3))
+        total += (-1) ** (3 - sum(corner)) * table[index]
+    return total > 0
+
+
 def fix_out_of_bound_patch_attempt(data, patch_shape, patch_index, ndim=3):
     """
     Pads the data and alters the patch index so that a patch will be correct.